@@ -8,10 +8,58 @@
 #
 # See the LICENSE file in the source distribution for further information.
 
+import json
+import pwd
+import re
 import shlex
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 from sos.report.plugins import Plugin, RedHatPlugin, UbuntuPlugin, PluginOpt
 
+# Maximum number of ids passed to a single batched podman invocation, to stay
+# well clear of ARG_MAX on hosts with many containers/images/volumes
+INSPECT_CHUNK_SIZE = 200
+
+# Upper bound on the number of users whose containers, images and volumes are
+# discovered concurrently
+DISCOVERY_WORKERS = 8
+
+# Defaults for UID_MIN and UID_MAX, bounding regular user accounts, used when
+# /etc/login.defs does not set them
+USER_UID_MIN = 1000
+USER_UID_MAX = 60000
+
+# Matches potentially sensitive key=value pairs in inspect output, see
+# Podman.postproc(). The negated character classes match exactly what lazy
+# wildcards up to the first '=' and '"' would, including keys that span a
+# '"' such as '"passphrase": "x=y"', while confining each attempt to a single
+# line so that large batched inspect files are scanned cheaply.
+_ENV_RE = re.compile(
+    r'(?P<var>(?i:pass|key|secret)[^=\n]*)=(?P<value>[^"\n]*)"'
+)
+
+
+def _chunks(items, size):
+    """Yield successive `size` sized slices of `items`"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class _PodmanInventory:
+    """The containers, images and volumes discovered for a single user
+
+    Images are stored as the reference they should be inspected by, so that
+    this only needs to be determined once.
+    """
+
+    __slots__ = ('container_ids', 'image_refs', 'volume_names')
+
+    def __init__(self, container_ids, image_refs, volume_names):
+        self.container_ids = container_ids
+        self.image_refs = image_refs
+        self.volume_names = volume_names
+
 
 class Podman(Plugin, RedHatPlugin, UbuntuPlugin):
     """Podman is a daemonless container management engine, and this plugin is
@@ -21,8 +69,10 @@ class Podman(Plugin, RedHatPlugin, UbuntuPlugin):
     General status information will be collected from podman commands, while
     detailed inspections of certain components will provide more insight
     into specific container problems. This detailed inspection is provided for
-    containers, images, networks, and volumes. Per-entity inspections will be
-    recorded in subdirs within sos_commands/podman/ for each of those types.
+    containers, images, networks, and volumes. Inspections are batched per
+    type, and recorded as podman_inspect_<type>s files (with a numeric suffix
+    for each additional batch) in subdirs within sos_commands/podman/ for
+    each of those types.
     """
 
     short_desc = 'Podman containers'
@@ -45,92 +95,187 @@ class Podman(Plugin, RedHatPlugin, UbuntuPlugin):
                     ' This may be useful or not depending on how/if the '
                     'container produces stdout/stderr output. Use cautiously '
                     'when also using the \'all\' option.')),
+        PluginOpt('log_lines', default=10000,
+                  desc='max lines per container log (0 or less for all)',
+                  long_desc=(
+                    'Limit \'podman logs\' output collected by the \'logs\' '
+                    'option to this many of the most recent lines per '
+                    'container. A value of 0 or less collects the full logs. '
+                    'The limit is not applied when the global \'all-logs\' '
+                    'option is used.')),
         PluginOpt('size', default=False,
                   desc='collect image sizes for podman ps'),
         PluginOpt('allusers', default=False,
-                  desc='collect for all users, including non root users')
+                  desc='collect for all users, including non root users'),
+        PluginOpt('trees', default=False,
+                  desc='collect podman image tree per image',
+                  long_desc=(
+                    'Capture \'podman image tree\' output for each discovered '
+                    'image. This requires one podman command per image, which '
+                    'can take a significant amount of time on systems with '
+                    'many images.')),
+        PluginOpt('max_containers', default=0,
+                  desc='limit number of containers inspected (0 or less=all)',
+                  long_desc=(
+                    'Only inspect and collect logs for up to this many '
+                    'containers per user. This is intended to be combined '
+                    'with the \'all\' option to bound collection time on '
+                    'systems with very large numbers of terminated '
+                    'containers. A value of 0 or less disables the limit.'))
     ]
 
+    # Status commands collected for every user podman data is collected for
+    _SUBCMDS = (
+        'info',
+        'image trust show',
+        'images',
+        'images --digests',
+        'pod ps',
+        'port --all',
+        'ps',
+        'ps -a',
+        'version',
+        'volume ls',
+        'system df -v',
+    )
+    _BASIC_CMDS = tuple(f"podman {s}" for s in _SUBCMDS)
+
     def setup(self):
         self.add_cmd_tags({
-            'podman images': 'podman_list_images',
+            # anchored so the json listing is not mistaken for the table
+            r'podman images( --digests)?$': 'podman_list_images',
             'podman ps': 'podman_list_containers'
         })
 
-        subcmds = [
-            'info',
-            'image trust show',
-            'images',
-            'images --digests',
-            'pod ps',
-            'port --all',
-            'ps',
-            'ps -a',
-            'stats --no-stream --all',
-            'version',
-            'volume ls',
-            'system df -v',
-        ]
-
         # Collect directory listings
         self.add_dir_listing([
             '/etc/cni',
             '/etc/containers'
         ], recursive=True)
 
-        # Always collect for root (None represents root user)
-        self._collect_for_user(None, '', subcmds)
-
-        # Only collect for non-root users if allusers option is enabled
-        if self.get_option('allusers'):
-            non_root_users = self._get_non_root_users()
-            for user in non_root_users:
-                if self._user_has_containers(user):
-                    self._collect_for_user(user, f'{user}/', subcmds)
+        # Options are read once here and handed down, rather than being
+        # looked up again for each user
+        opt_all = self.get_option('all')
+        opt_logs = self.get_option('logs')
+        opt_size = self.get_option('size')
+        opt_trees = self.get_option('trees')
+        opt_allusers = self.get_option('allusers')
+        opt_max_cons = self.get_option('max_containers')
+        opt_log_lines = self.get_option('log_lines')
+        if self.get_option('all_logs'):
+            opt_log_lines = -1
+
+        # Always collect for root (None represents root user), and only
+        # collect for non-root users if allusers option is enabled
+        users = [None]
+        if opt_allusers:
+            users.extend(self._get_non_root_users())
+
+        # Discovering what each non-root user has requires several podman
+        # commands to be run immediately, so do this concurrently across
+        # users. The collections themselves are then queued in a stable order.
+        # Note that commands run as another user switch to it in a preexec_fn,
+        # which calls pwd.getpwnam() in the forked child; preexec_fn is not
+        # safe while other threads are running and may deadlock with some NSS
+        # backends (e.g. sssd). Root discovery is mostly served from the
+        # policy's cached runtime data, so the pool is only used when there
+        # are other users to discover.
+        discover = partial(self._discover_for_user, get_all=opt_all,
+                           max_containers=opt_max_cons)
+        if len(users) > 1:
+            workers = min(DISCOVERY_WORKERS, len(users))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                inventories = list(pool.map(discover, users))
+        else:
+            inventories = [discover(user) for user in users]
+
+        for user, inventory in zip(users, inventories):
+            if inventory is None:
+                continue
+            subdir = f'{user}/' if user else ''
+            self._collect_for_user(user, subdir, inventory, size=opt_size,
+                                   logs=opt_logs, trees=opt_trees,
+                                   log_lines=opt_log_lines)
+
+    def _discover_for_user(self, user, get_all=False, max_containers=0):
+        """Get the inventory of containers, images and volumes of a specific
+        user, or None if a non-root user has no containers to collect data for
+        """
+        listing = None
+        if user is not None:
+            # a single listing of all containers tells us both whether the
+            # user has anything to collect and which containers to inspect
+            listing = self._exec_json('podman ps -a --format=json', user)
+            if not listing:
+                return None
+        return _PodmanInventory(
+            self._get_containers_list(user, listing, get_all,
+                                      max_containers),
+            self._get_images_list(user),
+            self._get_volumes_list(user)
+        )
 
-    def _collect_for_user(self, user, subdir, subcmds):
+    def _collect_for_user(self, user, subdir, inventory, size=False,
+                          logs=False, trees=False, log_lines=-1):
         """Collect all podman data for a specific user"""
-        self._collect_basic_info(user, subdir, subcmds)
+        self._collect_basic_info(user, subdir, size)
         self._collect_networks(user, subdir)
 
-        containers = self._get_containers_list(user)
-        images = self._get_images_list(user)
-        volumes = self._get_volumes_list(user)
+        # stats can take a while on busy systems, and there is nothing to
+        # report for users without containers
+        if inventory.container_ids:
+            self.add_cmd_output(
+                'podman stats --no-stream --all --format=json',
+                subdir=subdir,
+                runas=user
+            )
 
-        self._inspect_containers(user, subdir, containers)
-        self._inspect_images(user, subdir, images)
-        self._inspect_volumes(user, subdir, volumes)
-        self._collect_logs(user, subdir, containers)
+        self._inspect_containers(user, subdir, inventory.container_ids)
+        self._inspect_images(user, subdir, inventory.image_refs, trees)
+        self._inspect_volumes(user, subdir, inventory.volume_names)
+        if logs:
+            self._collect_logs(user, subdir, inventory.container_ids,
+                               log_lines)
+
+    def _get_uid_range(self):
+        """Get the UID range of regular user accounts from /etc/login.defs,
+        the same bounds lslogins uses, falling back to the shadow-utils
+        defaults for any that are unset or invalid
+        """
+        bounds = {'UID_MIN': USER_UID_MIN, 'UID_MAX': USER_UID_MAX}
+        try:
+            with open('/etc/login.defs', 'r', encoding='utf-8') as defs:
+                for line in defs:
+                    fields = line.split()
+                    if len(fields) < 2 or fields[0] not in bounds:
+                        continue
+                    try:
+                        bounds[fields[0]] = int(fields[1])
+                    except ValueError:
+                        self._log_info(f"Ignoring invalid {fields[0]} value "
+                                       f"'{fields[1]}' in login.defs")
+        except OSError as err:
+            self._log_debug(f"Could not read login.defs: {err}")
+        return bounds['UID_MIN'], bounds['UID_MAX']
 
     def _get_non_root_users(self):
-        """Get list of non-root users from the system"""
-        users = []
-        result = self.exec_cmd("lslogins -u -o USER --noheadings")
-        if result['status'] == 0:
-            for line in result['output'].splitlines():
-                user = line.strip()
-                if user and user != "root":
-                    users.append(user)
-        return users
-
-    def _user_has_containers(self, user):
-        """Check if user has any containers before collecting data"""
-        try:
-            cmd = self.exec_cmd("podman ps -aq", runas=user)
-            return cmd['status'] == 0 and cmd['output'].strip()
-        except subprocess.SubprocessError:
-            return False
+        """Get list of regular, non-root user accounts from the system"""
+        uid_min, uid_max = self._get_uid_range()
+        return [
+            p.pw_name for p in pwd.getpwall()
+            if uid_min <= p.pw_uid <= uid_max
+        ]
 
-    def _collect_basic_info(self, user, subdir, subcmds):
+    def _collect_basic_info(self, user, subdir, size=False):
         """Collect basic podman information and status"""
         self.add_cmd_output(
-            [f"podman {s}" for s in subcmds],
+            self._BASIC_CMDS,
             subdir=subdir,
             runas=user
         )
 
         # separately grab ps -s as this can take a *very* long time
-        if self.get_option('size'):
+        if size:
             self.add_cmd_output(
                 'podman ps -as',
                 priority=100,
@@ -152,133 +297,167 @@ class Podman(Plugin, RedHatPlugin, UbuntuPlugin):
             stderr=False
         )
         if pnets['status'] == 0:
+            # skip the header without copying the listing, and only split
+            # off the first column
             nets = [
-                pn.split()[0]
-                for pn in pnets['output'].splitlines()[1:]
+                pn.split(None, 1)[0]
+                for pn in islice(pnets['output'].splitlines(), 1, None)
+                if pn.strip()
             ]
-            self.add_cmd_output(
-                [f"podman network inspect {shlex.quote(net)}" for net in nets],
-                subdir=f'{subdir}networks',
-                tags='podman_network_inspect',
-                runas=user
-            )
-
-    def _get_containers_list(self, user):
-        """Get list of container IDs for the specified user"""
+            self._inspect_batched(user, subdir, 'network', nets,
+                                  'podman_network_inspect',
+                                  cmd='podman network inspect')
+
+    def _get_containers_list(self, user, listing=None, get_all=False,
+                             max_containers=0):
+        """Get list of container IDs for the specified user, using the json
+        `listing` of all of their containers for non-root users
+        """
         if user is None:
             # Use built-in method for root user
-            return [
+            containers = [
                 c[0] for c in self.get_containers(
                     runtime='podman',
-                    get_all=self.get_option('all')
+                    get_all=get_all
                 )
             ]
-
-        # For non-root users, use podman ps -q
-        cmd = "podman ps -q"
-        if self.get_option('all'):
-            cmd = "podman ps -aq"
-
-        containers_data = self.exec_cmd(cmd, runas=user, stderr=False)
-        if containers_data['status'] == 0:
-            return [
-                line.strip()
-                for line in containers_data['output'].splitlines()
-                if line.strip()
+        else:
+            # For non-root users, filter out terminated containers from the
+            # listing ourselves instead of asking podman for them separately
+            containers = [
+                c['Id'] for c in listing or []
+                if c.get('Id') and
+                (get_all or c.get('State') == 'running')
             ]
-        return []
+
+        # drop any duplicates while preserving order before applying the cap
+        containers = list(dict.fromkeys(containers))
+        if 0 < max_containers < len(containers):
+            self._log_info(f"Limiting collection to {max_containers} of "
+                           f"{len(containers)} containers")
+            containers = containers[:max_containers]
+        return containers
 
     def _get_images_list(self, user):
-        """Get list of images for the specified user"""
+        """Get list of image references to inspect for the specified user"""
         if user is None:
-            # Use built-in method for root user
-            return self.get_container_images(runtime='podman')
-
-        # For non-root users, collect image information manually
-        img_format = '{{.Repository}}:{{.Tag}} {{.ID}}'
-        image_data = self.exec_cmd(
-            f'podman images --no-trunc --format "{img_format}"',
-            runas=user,
-            stderr=False
-        )
-
-        if image_data['status'] == 0:
-            return [
-                line.rsplit(" ", 1)
-                for line in image_data['output'].strip().split("\n")
-                if line.strip()
+            # Use built-in method for root user, which the policy has already
+            # loaded from podman
+            images = self.get_container_images(runtime='podman')
+        else:
+            # For non-root users, collect the json listing and derive the
+            # images to inspect from it, rather than listing them separately
+            cmd = 'podman images --format=json'
+            res = self.collect_cmd_output(
+                cmd,
+                subdir=f'{user}/',
+                stderr=False,
+                runas=user
+            )
+            images = [
+                ((img.get('Names') or ['<none>'])[0], img['Id'])
+                for img in self._parse_json(cmd, res)
+                if img.get('Id')
             ]
-        return []
+        # dangling images have no usable name, so inspect them by id
+        refs = [
+            name if 'none' not in name else img_id
+            for name, img_id in images
+        ]
+        return list(dict.fromkeys(refs))
 
     def _get_volumes_list(self, user):
         """Get list of volumes for the specified user"""
         if user is None:
             # Use built-in method for root user
-            return self.get_container_volumes(runtime='podman')
-
-        # For non-root users, collect volume information manually
-        vol_format = '{{.Name}}'
-        vols = self.exec_cmd(
-            f'podman volume ls --format "{vol_format}"',
-            runas=user,
-            stderr=False
-        )
-        if vols['status'] == 0:
-            return [
-                v for v in vols['output'].splitlines()
-                if v.strip()
+            volumes = self.get_container_volumes(runtime='podman')
+        else:
+            # For non-root users, collect volume information manually
+            volumes = [
+                vol['Name'] for vol in
+                self._exec_json('podman volume ls --format=json', user)
+                if vol.get('Name')
             ]
-        return []
-
-    def _inspect_containers(self, user, subdir, containers):
-        """Collect detailed inspection data for containers"""
-        for container in containers:
+        return list(dict.fromkeys(volumes))
+
+    def _exec_json(self, cmd, user):
+        """Run a podman command that emits json as `user` and return the
+        decoded list of entities, or an empty list on failure
+        """
+        return self._parse_json(cmd, self.exec_cmd(cmd, runas=user,
+                                                   stderr=False))
+
+    def _parse_json(self, cmd, res):
+        """Decode the list of entities from the result of a podman command
+        that emits json, or return an empty list on failure
+        """
+        if res['status'] != 0:
+            return []
+        try:
+            return json.loads(res['output'] or '[]') or []
+        except ValueError as err:
+            self._log_info(f"Could not parse output of '{cmd}': {err}")
+            return []
+
+    def _inspect_batched(self, user, subdir, kind, ids, tags, cmd=None):
+        """Inspect `ids` of the given `kind` with as few podman invocations as
+        possible, chunking the ids to avoid overly long command lines. `cmd`
+        overrides the generic 'podman inspect' command used to do so
+        """
+        if cmd is None:
+            cmd = f"podman inspect --type={kind}"
+        for idx, chunk in enumerate(_chunks(ids, INSPECT_CHUNK_SIZE)):
+            quoted = ' '.join(shlex.quote(i) for i in chunk)
+            fname = f"podman_inspect_{kind}s"
+            if idx:
+                fname += f".{idx}"
             self.add_cmd_output(
-                f"podman inspect {shlex.quote(container)}",
-                subdir=f'{subdir}containers',
-                tags='podman_container_inspect',
+                f"{cmd} {quoted}",
+                suggest_filename=fname,
+                # an entity removed since discovery must not leave an error
+                # message in the json for the rest of the batch
+                stderr=False,
+                subdir=f'{subdir}{kind}s',
+                tags=tags,
                 runas=user
             )
 
-    def _inspect_images(self, user, subdir, images):
+    def _inspect_containers(self, user, subdir, containers):
+        """Collect detailed inspection data for containers"""
+        self._inspect_batched(user, subdir, 'container', containers,
+                              'podman_container_inspect')
+
+    def _inspect_images(self, user, subdir, images, trees=False):
         """Collect detailed inspection data for images"""
-        for img in images:
-            name, img_id = img
-            insp = name if 'none' not in name else img_id
-            self.add_cmd_output(
-                f"podman inspect {shlex.quote(insp)}",
-                subdir=f'{subdir}images',
-                tags='podman_image_inspect',
-                runas=user
-            )
-            self.add_cmd_output(
-                f"podman image tree {shlex.quote(insp)}",
-                subdir=f'{subdir}images/tree',
-                tags='podman_image_tree',
-                runas=user
-            )
+        if trees:
+            for insp in images:
+                self.add_cmd_output(
+                    f"podman image tree {shlex.quote(insp)}",
+                    subdir=f'{subdir}images/tree',
+                    tags='podman_image_tree',
+                    runas=user
+                )
+        self._inspect_batched(user, subdir, 'image', images,
+                              'podman_image_inspect')
 
     def _inspect_volumes(self, user, subdir, volumes):
         """Collect detailed inspection data for volumes"""
-        for vol in volumes:
+        self._inspect_batched(user, subdir, 'volume', volumes,
+                              'podman_volume_inspect')
+
+    def _collect_logs(self, user, subdir, containers, log_lines=-1):
+        """Collect stdout/stderr logs for containers, limited to the last
+        `log_lines` lines of each unless that is 0 or less
+        """
+        tail = f" --tail={log_lines}" if log_lines > 0 else ''
+        for con in containers:
             self.add_cmd_output(
-                f"podman volume inspect {shlex.quote(vol)}",
-                subdir=f'{subdir}volumes',
-                tags='podman_volume_inspect',
+                f"podman logs -t{tail} {shlex.quote(con)}",
+                subdir=f'{subdir}containers',
+                priority=50,
                 runas=user
             )
 
-    def _collect_logs(self, user, subdir, containers):
-        """Collect container logs if logs option is enabled"""
-        if self.get_option('logs'):
-            for con in containers:
-                self.add_cmd_output(
-                    f"podman logs -t {shlex.quote(con)}",
-                    subdir=f'{subdir}containers',
-                    priority=50,
-                    runas=user
-                )
-
     def postproc(self):
         # Attempts to match key=value pairs inside container inspect output
         # for potentially sensitive items like env vars that contain passwords.
@@ -290,10 +469,7 @@ class Podman(Plugin, RedHatPlugin, UbuntuPlugin):
         #             ],
         # This will mask values when the variable name looks like it may be
         # something worth obfuscating.
-
-        env_regexp = r'(?P<var>(pass|key|secret|PASS|KEY|SECRET).*?)=' \
-                      '(?P<value>.*?)"'
-        self.do_cmd_output_sub('*inspect*', env_regexp,
+        self.do_cmd_output_sub('*inspect*', _ENV_RE,
                                r'\g<var>=********"')
 
 # vim: set et ts=4 sw=4 :
@@ -0,0 +1,214 @@
+# This file is part of the sos project: https://github.com/sosreport/sos
+#
+# This copyrighted material is made available to anyone wishing to use,
+# modify, copy, or redistribute it subject to the terms and conditions of
+# version 2 of the GNU General Public License.
+#
+# See the LICENSE file in the source distribution for further information.
+import json
+import os
+import re
+import unittest
+from unittest.mock import mock_open, patch
+
+from sos.report.plugins import Plugin
+from sos.report.plugins.podman import Podman, _ENV_RE
+from sos.policies.distros import LinuxPolicy
+from sos.policies.init_systems import InitSystem
+
+
+class MockOptions:
+    all_logs = False
+    dry_run = False
+    since = None
+    log_size = 25
+    allow_system_changes = False
+    skip_commands = []
+    skip_files = []
+
+
+_FAILED = {'status': 1, 'output': ''}
+
+# the scrubbing pattern used before it was precompiled
+_OLD_ENV_RE = r'(?P<var>(pass|key|secret|PASS|KEY|SECRET).*?)=(?P<value>.*?)"'
+_ENV_SUBST = r'\g<var>=********"'
+
+_INSPECT_SAMPLE = """[
+     {
+          "Config": {
+               "Env": [
+                    "mypassword=supersecret",
+                    "container=oci",
+                    "API_KEY=abc=def",
+                    "SECRET_TOKEN="
+               ],
+               "Labels": {
+                    "passphrase": "x=y",
+                    "keyring": "none"
+               }
+          }
+     }
+]
+"""
+
+
+class PodmanPluginTests(unittest.TestCase):
+
+    def setUp(self):
+        self.plugin = Podman({
+            'sysroot': os.getcwd(),
+            'policy': LinuxPolicy(init=InitSystem(), probe_runtime=False),
+            'cmdlineopts': MockOptions(),
+            'devices': {}
+        })
+
+    @patch.object(Plugin, 'add_dir_listing')
+    @patch.object(Plugin, 'add_cmd_output')
+    @patch.object(Plugin, 'collect_cmd_output', return_value=_FAILED)
+    @patch.object(Plugin, 'exec_cmd', return_value=_FAILED)
+    def test_images_json_not_tagged_as_listing(self, *_mocks):
+        self.plugin.setup()
+        for cmd in ('podman images', 'podman images --digests'):
+            self.assertIn('podman_list_images',
+                          self.plugin.get_tags_for_cmd(cmd))
+        self.assertNotIn(
+            'podman_list_images',
+            self.plugin.get_tags_for_cmd('podman images --format=json')
+        )
+
+    def test_env_scrubbing_matches_previous_pattern(self):
+        old = re.sub(_OLD_ENV_RE, _ENV_SUBST, _INSPECT_SAMPLE)
+        new = _ENV_RE.sub(_ENV_SUBST, _INSPECT_SAMPLE)
+        self.assertEqual(old, new)
+        for secret in ('supersecret', 'abc', 'def', 'x=y'):
+            self.assertNotIn(secret, new)
+        self.assertIn('"passphrase": "x=********"', new)
+        self.assertIn('"container=oci"', new)
+        self.assertIn('"keyring": "none"', new)
+
+    def test_env_scrubbing_ignores_case(self):
+        self.assertEqual(
+            _ENV_RE.sub(_ENV_SUBST, '"Password=hunter2"'),
+            '"Password=********"'
+        )
+
+    def test_uid_range_from_login_defs(self):
+        defs = "# comment\nUID_MIN\t\t 2000\nUID_MAX 3000\nGID_MIN 500\n"
+        with patch('builtins.open', mock_open(read_data=defs)):
+            self.assertEqual(self.plugin._get_uid_range(), (2000, 3000))
+
+    def test_uid_range_defaults(self):
+        with patch('builtins.open', mock_open(read_data="UID_MIN foo\n")):
+            self.assertEqual(self.plugin._get_uid_range(), (1000, 60000))
+        with patch('builtins.open', side_effect=FileNotFoundError):
+            self.assertEqual(self.plugin._get_uid_range(), (1000, 60000))
+
+    def test_max_containers_cap(self):
+        listing = [{'Id': cid, 'State': 'running'} for cid in 'abc']
+        for cap, expected in ((0, ['a', 'b', 'c']), (-1, ['a', 'b', 'c']),
+                              (2, ['a', 'b']), (5, ['a', 'b', 'c'])):
+            self.assertEqual(
+                self.plugin._get_containers_list('user', listing,
+                                                 max_containers=cap),
+                expected
+            )
+
+    def _run_setup(self, outputs, users=(), **opts):
+        """Run setup() with podman command output mocked from `outputs`, keyed
+        by (command, user), and return the (command, kwargs) pairs queued
+        via add_cmd_output()
+        """
+        def _fake_exec(cmd, runas=None, **_kwargs):
+            if (cmd, runas) in outputs:
+                return {'status': 0, 'output': outputs[(cmd, runas)]}
+            return _FAILED
+
+        for opt, val in opts.items():
+            self.plugin.set_option(opt, val)
+        queued = []
+
+        def _fake_add(cmds, **kwargs):
+            for cmd in [cmds] if isinstance(cmds, str) else cmds:
+                queued.append((cmd, kwargs))
+
+        with patch.object(Plugin, 'exec_cmd', side_effect=_fake_exec), \
+                patch.object(Plugin, 'collect_cmd_output',
+                             side_effect=_fake_exec), \
+                patch.object(Plugin, 'add_cmd_output',
+                             side_effect=_fake_add), \
+                patch.object(Plugin, 'add_dir_listing'), \
+                patch.object(Podman, '_get_non_root_users',
+                             return_value=list(users)):
+            self.plugin.setup()
+        return queued
+
+    def test_setup_batches_inspections(self):
+        cons = [{'Id': f"c{i:03}", 'State': 'running'} for i in range(200)]
+        cons.append({'Id': "odd id;x", 'State': 'running'})
+        cons.append({'Id': 'stopped', 'State': 'exited'})
+        outputs = {
+            ('podman ps -a --format=json', 'alice'): json.dumps(cons),
+            ('podman images --format=json', 'alice'): json.dumps([
+                {'Id': 'i1', 'Names': ['quay.io/x:latest']},
+                {'Id': 'i2', 'Names': None},
+            ]),
+            ('podman volume ls --format=json', 'alice'): '{not json',
+            ('podman ps -a --format=json', 'bob'): '[]',
+            ('podman ps -a --format=json', 'carol'): 'null',
+            ('podman ps -a --format=json', 'dave'): 'garbage',
+        }
+        queued = self._run_setup(outputs, users=('alice', 'bob', 'carol',
+                                                 'dave'), allusers=True)
+
+        # users without a usable container listing are skipped entirely
+        self.assertEqual(
+            {kw.get('runas') for _, kw in queued}, {None, 'alice'}
+        )
+
+        inspects = [(cmd, kw) for cmd, kw in queued
+                    if kw.get('runas') == 'alice' and
+                    kw.get('suggest_filename')]
+        self.assertEqual(
+            [(kw['suggest_filename'], kw['subdir']) for _, kw in inspects],
+            [('podman_inspect_containers', 'alice/containers'),
+             ('podman_inspect_containers.1', 'alice/containers'),
+             ('podman_inspect_images', 'alice/images')]
+        )
+        for _, kw in inspects:
+            self.assertFalse(kw['stderr'])
+
+        first, second, images = [cmd for cmd, _ in inspects]
+        # 200 ids per batch, and terminated containers are left out
+        self.assertEqual(len(first.split()), 3 + 200)
+        self.assertTrue(first.startswith('podman inspect --type=container '))
+        self.assertEqual(second,
+                         "podman inspect --type=container 'odd id;x'")
+        self.assertNotIn('stopped', first + second)
+        self.assertEqual(images,
+                         'podman inspect --type=image quay.io/x:latest i2')
+
+    def test_setup_log_tail(self):
+        outputs = {
+            ('podman ps -a --format=json', 'alice'): json.dumps(
+                [{'Id': 'c1', 'State': 'running'}]
+            ),
+        }
+        for lines, flag in ((10000, ' --tail=10000'), (5, ' --tail=5'),
+                            (0, ''), (-1, '')):
+            queued = self._run_setup(outputs, users=('alice',),
+                                     allusers=True, logs=True,
+                                     log_lines=lines)
+            self.assertIn(f"podman logs -t{flag} c1",
+                          [cmd for cmd, _ in queued])
+
+        # the global all-logs option overrides the limit
+        self.plugin.commons['cmdlineopts'].all_logs = True
+        queued = self._run_setup(outputs, users=('alice',), allusers=True,
+                                 logs=True, log_lines=5)
+        self.assertIn("podman logs -t c1", [cmd for cmd, _ in queued])
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+# vim: set et ts=4 sw=4 :